@@ -175,13 +175,13 @@ class ToolGUI:
             self.task.save_task_to_chain()
             self.pick_data_list.append(self.pick_data)
             self.place_data_list.append(self.place_data)
-        if None in self.task.pick_pose[:-1] or None in self.task.place_pose[:-1]:
+        if not self.task.pick_pose.all_valid(stop=-1) or not self.task.place_pose.all_valid(stop=-1):
             rospy.logwarn("Action pair (pick-place) pose not found or chain contains broken steps")
             return
         
         action = {}
-        pick_list = self.task.pick_pose[:-1]
-        place_list = self.task.place_pose[:-1]
+        pick_list = self.task.pick_pose.tolist()[:-1]
+        place_list = self.task.place_pose.tolist()[:-1]
         ind = 0
         for pos in range(len(pick_list)):
             pick_key = f"pose{ind}"
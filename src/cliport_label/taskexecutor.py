@@ -2,25 +2,47 @@
 from typing import List, Any
 from dataclasses import dataclass
 from enum import Enum
-import copy
 
 import numpy as np
 import actionlib
 import rospy
 import moveit_commander
 import geometry_msgs.msg
-import tf
+import tf2_ros
 import math
-import time
 
 import franka_gripper.msg
 import franka_msgs.msg
-from moveit_msgs.msg import RobotTrajectory
+from moveit_msgs.msg import RobotState, RobotTrajectory
 from actionlib_msgs.msg import GoalStatusArray
 
-from cliport_label.utils import get_avg_3d_centroid, get_relative_orientation
+from cliport_label.utils import PoseChain, get_avg_3d_centroid, get_pose44, get_yaw_orientations
 from moveit_msgs.msg import Constraints, OrientationConstraint
 
+# Joint values of the panda arm at home position
+_HOME_JOINTS = np.array([0.0002472882756288363,
+                         -0.7854469971154865,
+                         0.00020762182355719505,
+                         -2.3573765974308567,
+                         0.0008450016330628508,
+                         1.5715642473167843,
+                         0.7857555058451898], dtype=np.float64)
+# _HOME_JOINTS = np.array([-0.10978979745454956, -0.7703535289764404, -0.05097640468462238, -2.3268556568809795,
+#                          0.0010342414430801817, 1.5708663142522175, 0.7840747220798833], dtype=np.float64)
+_HOME_JOINTS_LIST = _HOME_JOINTS.tolist()
+
+
+def set_pose(pose, xyz, wxyz) -> geometry_msgs.msg.Pose:
+    """Set pose message fields in place from position and orientation (WXYZ) arrays"""
+    pose.position.x = float(xyz[0])
+    pose.position.y = float(xyz[1])
+    pose.position.z = float(xyz[2])
+    pose.orientation.w = float(wxyz[0])
+    pose.orientation.x = float(wxyz[1])
+    pose.orientation.y = float(wxyz[2])
+    pose.orientation.z = float(wxyz[3])
+    return pose
+
 
 @dataclass
 class TaskInfo:
@@ -50,7 +72,13 @@ class GoalStatus(Enum):
     #    sent over the wire by an action server
 
 
+# Status value to enum lookup for the status callback
+_GOAL_STATUS = {status.value: status for status in GoalStatus}
+
+
 class TaskExecutor:
+    # Robot modes which require error recovery before moving
+    _REFLEX_MODES = frozenset([franka_msgs.msg.FrankaState.ROBOT_MODE_REFLEX])
 
     def __init__(self, config) -> None:
         """Initialize stuff"""
@@ -61,9 +89,11 @@ class TaskExecutor:
         self.scene = moveit_commander.PlanningSceneInterface()
         self.move_group = moveit_commander.MoveGroupCommander("panda_arm")
         # Set grasp tool as EE link
-        self.move_group.set_end_effector_link("panda_hand_tcp")
+        self._ee_link = "panda_hand_tcp"
+        self.move_group.set_end_effector_link(self._ee_link)
         self.subscriber_feedback = rospy.Subscriber("/move_group/status",
-                                                    GoalStatusArray, self.feedback_callback, )
+                                                    GoalStatusArray, self.feedback_callback,
+                                                    queue_size=1, buff_size=2**16, tcp_nodelay=True)
         self.move_group_status = GoalStatus.PENDING
         # Clients to send commands to the gripper
         self.grasp_action_client = actionlib.SimpleActionClient("/franka_gripper/grasp", franka_gripper.msg.GraspAction)
@@ -72,28 +102,32 @@ class TaskExecutor:
         self.rotation_angles = 10
         # Transformation Matrices
         # Pixel to Camera coordinate system
-        self.intrinsic = [
+        self.K = np.array([
             [609.9600830078125, 0.0, 336.7248229980469, ],
             [0.0, 609.9955444335938, 249.56271362304688],
             [0.0, 0.0, 1.0]
-        ]
+        ], dtype=np.float32)
+        self.K_inv = np.linalg.inv(self.K).astype(np.float32)
         # aligned_depth_to_color_frame
-        self.listener = tf.TransformListener()
-        self.listener.waitForTransform("/panda_link0", "/camera_color_optical_frame", rospy.Time(0),
-                                       rospy.Duration(4))
-        transform = self.listener.lookupTransform("/panda_link0",
-                                                  "/camera_color_optical_frame",  # target frame
-                                                  rospy.Time(0), )  # get the tf at first available time
-        # Camera to end effector transform 
-        self.extrinsic = {
-            'xyz': transform[0],
-            'quaternion': transform[1]
-        }
+        # Look up the transform once, the listener is only needed for that lookup
+        tf_buffer = tf2_ros.Buffer()
+        tf_listener = tf2_ros.TransformListener(tf_buffer)
+        transform = tf_buffer.lookup_transform("panda_link0",
+                                               "camera_color_optical_frame",  # target frame
+                                               rospy.Time(0),  # get the tf at first available time
+                                               rospy.Duration(4)).transform
+        tf_listener.unregister()
+        # Camera to base transform as a single homogeneous matrix
+        translation, rotation = transform.translation, transform.rotation
+        self.T_cam_to_base = get_pose44([translation.x, translation.y, translation.z],
+                                        [rotation.w, rotation.x, rotation.y, rotation.z]).astype(np.float32)
+        # Reusable waypoint messages for cartesian paths
+        self._waypoint_poses = [geometry_msgs.msg.Pose() for _ in range(2)]
         # Our Pick-Place action pose
-        self.pick_pose = []
-        self.place_pose = []
-        rospy.loginfo(f"Camera intrinsic: {self.intrinsic}")
-        rospy.loginfo(f"Camera-to-base extrinsic: {self.extrinsic}")
+        self.pick_pose = PoseChain()
+        self.place_pose = PoseChain()
+        rospy.loginfo(f"Camera intrinsic: {self.K}")
+        rospy.loginfo(f"Camera-to-base extrinsic: {self.T_cam_to_base}")
 
         # reflex recovery
         self.robot_in_reflex = False
@@ -102,29 +136,39 @@ class TaskExecutor:
                                                  queue_size=1)
         self.robot_mode_sub = rospy.Subscriber("/franka_state_controller/franka_states",
                                                franka_msgs.msg.FrankaState, self.franka_state_callback,
-                                               queue_size=1)
-        time.sleep(1)
+                                               queue_size=1, buff_size=2**16, tcp_nodelay=True)
+        # Wait for robot state, move group and gripper instead of a fixed delay
+        for topic, msg_type in (("/franka_state_controller/franka_states", franka_msgs.msg.FrankaState),
+                                ("/move_group/status", GoalStatusArray)):
+            try:
+                rospy.wait_for_message(topic, msg_type, timeout=2.0)
+            except rospy.ROSException:
+                rospy.logwarn(f"No message received from {topic}")
+        if self.config["taskexecutor"]["enable_gripper"]:
+            for client in (self.grasp_action_client, self.move_action_client):
+                if not client.wait_for_server(rospy.Duration(2.0)):
+                    rospy.logwarn("Gripper action server is not available")
 
         # Bring robot to home position during initialization
         self.home(wait=True)
         self.default_ee_pose = self.move_group.get_current_pose()
         rospy.loginfo(f"End effector pose at home location: {self.default_ee_pose}")
+        orientation = self.default_ee_pose.pose.orientation
+        self._default_ee_wxyz = np.array([orientation.w, orientation.x, orientation.y, orientation.z], dtype=np.float64)
+        self.init_path_constraints()
+        self.init_target_orientations()
 
     def franka_state_callback(self, msg: franka_msgs.msg.FrankaState):
-        if msg.robot_mode == franka_msgs.msg.FrankaState.ROBOT_MODE_REFLEX:
-            self.robot_in_reflex = True
-        else:
-            self.robot_in_reflex = False
+        self.robot_in_reflex = msg.robot_mode in self._REFLEX_MODES
 
     def init_path_constraints(self):
         self.path_constraints = Constraints()
         self.path_constraints.name = "yawonly"
         orientation_constraint = OrientationConstraint()
-        ee_link = self.move_group.get_end_effector_link()
-        pose = self.move_group.get_current_pose(ee_link)
-        orientation_constraint.header = pose.header
-        orientation_constraint.link_name = ee_link
-        orientation_constraint.orientation = pose.pose.orientation
+        # Constrain orientation to the one at home position
+        orientation_constraint.header = self.default_ee_pose.header
+        orientation_constraint.link_name = self._ee_link
+        orientation_constraint.orientation = self.default_ee_pose.pose.orientation
         orientation_constraint.absolute_x_axis_tolerance = 0.1
         orientation_constraint.absolute_y_axis_tolerance = 0.1
         orientation_constraint.absolute_z_axis_tolerance = 3.14
@@ -133,6 +177,20 @@ class TaskExecutor:
         self.path_constraints.orientation_constraints.append(orientation_constraint)
         # self.move_group.set_path_constraints(self.path_constraints)
 
+    def init_target_orientations(self):
+        """Precompute target orientations for every discrete rotation relative to the home pose"""
+        # Ceil division so that the last partial step (e.g. 357 degrees with 7 degree steps) gets its own entry
+        yaw_rotations = np.arange(-(-360 // self.rotation_angles)) * self.rotation_angles
+        self._target_wxyz_lut = get_yaw_orientations(self._default_ee_wxyz, yaw_rotations)
+        self._target_wxyz_lut_angles = self.rotation_angles
+
+    def compose_target_wxyz(self, rotation: int) -> np.ndarray:
+        """Get target orientation (WXYZ) for a discrete rotation relative to the home pose"""
+        # Rotation angle step can be changed after initialization (e.g. by GUI)
+        if self._target_wxyz_lut_angles != self.rotation_angles:
+            self.init_target_orientations()
+        return self._target_wxyz_lut[rotation % len(self._target_wxyz_lut)]
+
     def enable_path_constraints(self):
         self.move_group.set_path_constraints(self.path_constraints)
 
@@ -155,43 +213,39 @@ class TaskExecutor:
             self.stop()
             self.home()
             # Get target position and orientation
-            target_xyz, camera_xyz = get_avg_3d_centroid(data.img_depth, data.bbox, self.intrinsic, self.extrinsic)
+            target_xyz, camera_xyz = get_avg_3d_centroid(data.img_depth, data.bbox, self.K_inv, self.T_cam_to_base)
             rospy.loginfo(f"{camera_xyz = }")
             rospy.loginfo(f"{target_xyz = }")
-            ee_wxyz = [self.default_ee_pose.pose.orientation.w,
-                       self.default_ee_pose.pose.orientation.x,
-                       self.default_ee_pose.pose.orientation.y,
-                       self.default_ee_pose.pose.orientation.z]
-            target_wxyz = get_relative_orientation(ee_wxyz, data.rotation * self.rotation_angles)
-
-            pose = geometry_msgs.msg.Pose()
-            pose.position.x = target_xyz[0]
-            pose.position.y = target_xyz[1]
-            pose.position.z = target_xyz[2]
-            pose.orientation.w = target_wxyz[0]
-            pose.orientation.x = target_wxyz[1]
-            pose.orientation.y = target_wxyz[2]
-            pose.orientation.z = target_wxyz[3]
+            target_wxyz = self.compose_target_wxyz(data.rotation)
 
-            # Move above object and open gripper
+            z_offsets = np.array([[0.0, 0.0, z_offset_up], [0.0, 0.0, -z_offset_down]])
+            pose_up, pose_down = self._make_waypoints(target_xyz + z_offsets, target_wxyz)
+
+            # Plan all segments before moving, each segment starts where the previous one ends
+            approach_plan = self.plan_cartesian_path([pose_up], 0.4)
+            grasp_plan = self.plan_cartesian_path([pose_down], 0.05, self.get_end_state(approach_plan))
+            lift_plan = self.plan_cartesian_path([pose_up], 0.1, self.get_end_state(grasp_plan))
+
+            # Move above object while opening gripper
             rospy.loginfo("Moving towards pick object and opening gripper")
-            pose_up = copy.deepcopy(pose)
-            pose_up.position.z += z_offset_up
-            self.execute_cartesian_path([pose_up], 0.4)
-            self.open_gripper()
-            # Move down and grasp object
+            self.open_gripper(wait=False)
+            self.execute_plan(approach_plan)
+            # Move down once gripper is open and grasp object
+            if not self.wait_gripper(self.move_action_client):
+                rospy.logerr("Gripper did not open, aborting pick")
+                return
             rospy.loginfo("Moving down and grasping pick object")
-            pose_down = copy.deepcopy(pose)
-            pose_down.position.z -= z_offset_down
-            self.execute_cartesian_path([pose_down], 0.05)
-            self.close_gripper()
+            self.execute_plan(grasp_plan)
+            if not self.close_gripper():
+                rospy.logerr("Gripper did not grasp, aborting pick")
+                return
             # Move up again
             rospy.loginfo("Moving up again after picking object")
-            self.execute_cartesian_path([pose_up], 0.1)
+            self.execute_plan(lift_plan)
             task_n = len(self.pick_pose) - 1
-            try:
+            if task_n > -1:
                 self.pick_pose[task_n] = (target_xyz, target_wxyz)
-            except IndexError:
+            else:
                 self.pick_pose.append((target_xyz, target_wxyz))
 
     def place(self, data: TaskInfo):
@@ -211,41 +265,30 @@ class TaskExecutor:
             self.home()
             # Get target position and orientation
 
-            target_xyz, camera_xyz = get_avg_3d_centroid(data.img_depth, data.bbox, self.intrinsic, self.extrinsic)
+            target_xyz, camera_xyz = get_avg_3d_centroid(data.img_depth, data.bbox, self.K_inv, self.T_cam_to_base)
             # We add Z offset in our xyz
             target_xyz[2] += z_offset_up
             rospy.loginfo(f"{camera_xyz = }")
             rospy.loginfo(f"{target_xyz = }")
-            ee_wxyz = [self.default_ee_pose.pose.orientation.w,
-                       self.default_ee_pose.pose.orientation.x,
-                       self.default_ee_pose.pose.orientation.y,
-                       self.default_ee_pose.pose.orientation.z]
-            target_wxyz = get_relative_orientation(ee_wxyz, data.rotation * self.rotation_angles)
-
-            pose = geometry_msgs.msg.Pose()
-            pose.position.x = target_xyz[0]
-            pose.position.y = target_xyz[1]
-            pose.position.z = target_xyz[2]
-            pose.orientation.w = target_wxyz[0]
-            pose.orientation.x = target_wxyz[1]
-            pose.orientation.y = target_wxyz[2]
-            pose.orientation.z = target_wxyz[3]
+            target_wxyz = self.compose_target_wxyz(data.rotation)
+
+            pose, = self._make_waypoints(target_xyz, target_wxyz)
 
             # Move above object and open gripper
             rospy.loginfo("Moving towards place object and opening gripper")
             self.execute_cartesian_path([pose], 0.2)
             self.open_gripper()
             task_n = len(self.place_pose) - 1
-            try:
+            if task_n > -1:
                 self.place_pose[task_n] = (target_xyz, target_wxyz)
-            except IndexError:
+            else:
                 self.place_pose.append((target_xyz, target_wxyz))
 
     def feedback_callback(self, data):
         """Callback function for topic /move_group/feedback"""
         # Only take the latest status
         if len(data.status_list) > 0:
-            self.move_group_status = GoalStatus(data.status_list[-1].status)
+            self.move_group_status = _GOAL_STATUS[data.status_list[-1].status]
 
     def home(self, wait=True):
         if self.robot_in_reflex:
@@ -253,25 +296,30 @@ class TaskExecutor:
             self.recover()
         else:
             """Goto home position"""
-            # Clear existing pose targets
-            self.move_group.clear_pose_targets()
-            # Plan home joint values
-            home_joint_values = [0.0002472882756288363,
-                                 -0.7854469971154865,
-                                 0.00020762182355719505,
-                                 -2.3573765974308567,
-                                 0.0008450016330628508,
-                                 1.5715642473167843,
-                                 0.7857555058451898]
-            # home_joint_values = [-0.10978979745454956, -0.7703535289764404, -0.05097640468462238, -2.3268556568809795,
-            #                     0.0010342414430801817, 1.5708663142522175, 0.7840747220798833]
-            self.move_group.set_joint_value_target(home_joint_values)
-            plan = self.move_group.plan()
-            self.execute_plan(plan, wait)
-            self.init_path_constraints()
-
-    def execute_cartesian_path(self, waypoints, velocity_scaling_factor=1.0):
-        """Execute cartesian path with some safety checks regarding pose waypoints"""
+            # Skip planning if robot is already at home (max joint difference in radians).
+            # Joint values are empty while move group has not received a robot state yet
+            joint_values = np.asarray(self.move_group.get_current_joint_values())
+            if joint_values.shape == _HOME_JOINTS.shape and np.max(np.abs(joint_values - _HOME_JOINTS)) < 1e-3:
+                rospy.loginfo("Robot is already at home position")
+            else:
+                # Clear existing pose targets
+                self.move_group.clear_pose_targets()
+                # Plan home joint values (move group bindings only accept a list)
+                self.move_group.set_joint_value_target(_HOME_JOINTS_LIST)
+                plan = self.move_group.plan()
+                self.execute_plan(plan, wait)
+
+    def _make_waypoints(self, xyz, wxyz) -> List[geometry_msgs.msg.Pose]:
+        """Build waypoint poses from Nx3 (or 3) positions sharing one orientation (WXYZ).
+        Pose messages are reused by the next call, which is safe as planning does not keep references to them"""
+        xyz = np.reshape(xyz, (-1, 3))
+        while len(self._waypoint_poses) < len(xyz):
+            self._waypoint_poses.append(geometry_msgs.msg.Pose())
+        return [set_pose(pose, position, wxyz) for pose, position in zip(self._waypoint_poses, xyz)]
+
+    def plan_cartesian_path(self, waypoints, velocity_scaling_factor=1.0, start_state=None):
+        """Plan cartesian path with some safety checks regarding pose waypoints. Plans from current state if start state is not given"""
+        # Every waypoint sent to the arm passes here, so clamp z to a safe range
         z_min, z_max = 0.01, 0.30
         for pose in waypoints:
             if pose.position.z < z_min:
@@ -280,14 +328,38 @@ class TaskExecutor:
             if pose.position.z > z_max:
                 rospy.logwarn(f"{pose.position.z = } is invalid. Using {z_max} instead")
                 pose.position.z = z_max
+        if start_state is not None:
+            self.move_group.set_start_state(start_state)
         plan, _ = self.move_group.compute_cartesian_path(waypoints, 0.01, 0.0,
                                                          path_constraints=self.path_constraints)  # jump_threshold
-        # use retime to control move speed
-        plan = self.move_group.retime_trajectory(self.robot.get_current_state(),
-                                                 plan,
-                                                 velocity_scaling_factor)
+        self.move_group.set_start_state_to_current_state()
+        if not plan.joint_trajectory.points:
+            rospy.logwarn("Could not plan cartesian path through waypoints")
+        # use retime to control move speed, planned path is already timed for full speed
+        elif velocity_scaling_factor < 0.999:
+            if start_state is None:
+                start_state = self.robot.get_current_state()
+            plan = self.move_group.retime_trajectory(start_state,
+                                                     plan,
+                                                     velocity_scaling_factor)
+        return plan
+
+    def execute_cartesian_path(self, waypoints, velocity_scaling_factor=1.0):
+        """Plan and execute cartesian path from current state"""
+        plan = self.plan_cartesian_path(waypoints, velocity_scaling_factor)
         self.execute_plan(plan)
 
+    def get_end_state(self, plan: RobotTrajectory) -> RobotState:
+        """Get robot state at the end of a planned trajectory"""
+        state = self.robot.get_current_state()
+        trajectory = plan.joint_trajectory
+        if trajectory.points:
+            position = list(state.joint_state.position)
+            for name, value in zip(trajectory.joint_names, trajectory.points[-1].positions):
+                position[state.joint_state.name.index(name)] = value
+            state.joint_state.position = position
+        return state
+
     def execute_plan(self, plan, wait=True) -> None:
         """Execute a given plan through move group"""
         rospy.loginfo(f"Current move group status: {self.move_group_status}")
@@ -312,27 +384,40 @@ class TaskExecutor:
         self.stop()
         moveit_commander.roscpp_shutdown()
 
-    def open_gripper(self) -> None:
-        """Open gripper"""
+    def open_gripper(self, wait=True) -> bool:
+        """Open gripper. Returns False if waited goal did not succeed"""
         if not self.config["taskexecutor"]["enable_gripper"]:
-            return
+            return True
         goal = franka_gripper.msg.MoveGoal()
         goal.width = 0.08
         goal.speed = 0.1
         self.move_action_client.send_goal(goal)
-        self.move_action_client.wait_for_result()
+        return not wait or self.wait_gripper(self.move_action_client)
 
-    def close_gripper(self):
-        """Grasp object by closing gripper"""
+    def close_gripper(self, wait=True) -> bool:
+        """Grasp object by closing gripper. Returns False if waited goal did not succeed"""
         if not self.config["taskexecutor"]["enable_gripper"]:
-            return
+            return True
         goal = franka_gripper.msg.GraspGoal()
         goal.width = 0.00
         goal.speed = 0.1
         goal.force = 5  # limits 0.01 - 50 N
         goal.epsilon = franka_gripper.msg.GraspEpsilon(inner=0.08, outer=0.08)
         self.grasp_action_client.send_goal(goal)
-        self.grasp_action_client.wait_for_result()
+        return not wait or self.wait_gripper(self.grasp_action_client)
+
+    def wait_gripper(self, client, timeout=10.0) -> bool:
+        """Wait for the last goal of given gripper client. Returns True if it succeeded within timeout (seconds)"""
+        if not self.config["taskexecutor"]["enable_gripper"]:
+            return True
+        if not client.wait_for_result(rospy.Duration(timeout)):
+            rospy.logwarn(f"Gripper goal did not finish within {timeout} s")
+            return False
+        state = _GOAL_STATUS[client.get_state()]
+        if state is not GoalStatus.SUCCEEDED:
+            rospy.logwarn(f"Gripper goal finished with status {state}")
+            return False
+        return True
 
     def recover(self):
         self.stop()
@@ -356,23 +441,20 @@ class TaskExecutor:
             rospy.loginfo(f"task_pos is {task_pos} (not present/first)")
 
     def reset_task(self):
-        self.pick_pose = []
-        self.place_pose = []
+        self.pick_pose.clear()
+        self.place_pose.clear()
 
     def save_task_to_chain(self):
         self.pick_pose.append(None)
         self.place_pose.append(None)
 
     def is_valid(self):
-        pick_is_valid = None not in self.pick_pose
-        place_is_valid = None not in self.place_pose
+        pick_is_valid = self.pick_pose.all_valid()
+        place_is_valid = self.place_pose.all_valid()
         same_length = len(self.pick_pose) == len(self.place_pose)
         return pick_is_valid and place_is_valid and same_length
 
     def data_exists(self):
-        try:
-            pick_exists = self.pick_pose[len(self.pick_pose) - 1] is not None
-            place_exists = self.place_pose[len(self.place_pose) - 1] is not None
-        except IndexError:
-            pick_exists = place_exists = False
+        pick_exists = self.pick_pose.last_valid()
+        place_exists = self.place_pose.last_valid()
         return pick_exists and place_exists
@@ -1,8 +1,13 @@
 """Utility functions"""
+from typing import List, Any
+
 import numpy as np
 import cv2
 from transforms3d._gohlketransforms import quaternion_matrix, translation_matrix, euler_matrix, quaternion_from_euler, quaternion_from_matrix
 
+# Depth values (mm) at or above this are treated as invalid
+MAX_DEPTH = 10000
+
 def get_origin_from_bbox(bbox):
     """Interpret origin from bounding box coordinates"""
     boxw, boxh = abs(bbox[0][0] - bbox[1][0]), abs(bbox[0][1] - bbox[1][1])
@@ -121,25 +126,33 @@ def map_centroid_to_3d(depthFrame, bbox, intrinsics, extrinsics):
     #TODO: make this
     return None
 
-def get_avg_3d_centroid(depth, bbox, intrinsics, extrinsics):
-    """Using depth map and bounding box in pixel coordinate, find the equivalent average 3d centroid in world coordinate system"""
+def get_median_3d_point(depth, bbox, intrinsics_inv):
+    """Get median 3d point in camera coordinates (depth units) of the valid depth pixels inside bounding box"""
+    (x0, y0), (x1, y1) = bbox
+    roi = depth[y0:y1, x0:x1]
+    # Ignore missing and out of range depth values
+    rows, cols = np.nonzero((roi > 0) & (roi < MAX_DEPTH))
+    z = roi[rows, cols].astype(np.float32)
+    # Deproject only the valid pixels
+    x = (intrinsics_inv[0, 0] * (cols + x0).astype(np.float32) + intrinsics_inv[0, 2]) * z
+    y = (intrinsics_inv[1, 1] * (rows + y0).astype(np.float32) + intrinsics_inv[1, 2]) * z
+    # Coordinate arrays are temporaries so the median may partition them in place
+    return np.array([np.median(x, overwrite_input=True),
+                     np.median(y, overwrite_input=True),
+                     np.median(z, overwrite_input=True)], dtype=np.float32)
+
+
+def get_avg_3d_centroid(depth, bbox, intrinsics_inv, extrinsics):
+    """Using depth map and bounding box in pixel coordinate, find the equivalent average 3d centroid in world coordinate system.
+    Extrinsics is the 4x4 homogeneous camera to world transformation matrix. Centroids are returned as float32 arrays of shape (3,)"""
     # bbox = np.sort(bbox, axis=0)
-    xyz = get_pointcloud(depth, np.array(intrinsics))
-    xyz = xyz[bbox[0][1]: bbox[1][1], bbox[0][0]: bbox[1][0]]
-    nz_xyz = np.nonzero(xyz[:,:,2])
-    centroid_camera = [np.median(xyz[:, :, 0][nz_xyz]), np.median(xyz[:, :, 1][nz_xyz]), np.median(xyz[:, :, 2][nz_xyz])]
     # Convert mm to m units
-    centroid_camera = [float(x)/1000 for x in centroid_camera]
-    # Construct transformation matrix
-    position = translation_matrix(extrinsics['xyz'])
-    ## XYZW to WXYZ
-    quaternion = [extrinsics['quaternion'][-1], *extrinsics['quaternion'][:-1]]
-    rotation = quaternion_matrix(quaternion)
-    transform = np.dot(position, rotation)
-    # Apply transformation
-    centroid_world = np.dot(transform, np.array([[*centroid_camera, 1]]).T)[:-1] # this calculation doesn't consider occlusion
+    centroid_camera = get_median_3d_point(depth, bbox, intrinsics_inv) / 1000
+    # Apply camera to base transformation
+    centroid_world = extrinsics[:3, :3] @ centroid_camera + extrinsics[:3, 3] # this calculation doesn't consider occlusion
+    centroid_world = centroid_world.astype(np.float32, copy=False)
 
-    return [float(x) for x in centroid_world], centroid_camera
+    return centroid_world, centroid_camera
 
 
 def get_relative_orientation(reference, yaw_rotation):
@@ -149,3 +162,81 @@ def get_relative_orientation(reference, yaw_rotation):
     res_matrix = np.dot(rel_matrix, ref_matrix)
     
     return quaternion_from_matrix(res_matrix)
+
+
+def get_yaw_orientations(reference, yaw_rotations):
+    """Get orientations relative to reference for a batch of yaw rotations. Reference is in quaternion (WXYZ) while rotations are given in yaw degrees. Returned orientations are an Nx4 array of quaternions (WXYZ)"""
+    w, x, y, z = np.asarray(reference, dtype=np.float64)
+    half_yaw = np.radians(np.asarray(yaw_rotations, dtype=np.float64)) / 2
+    c, s = np.cos(half_yaw), np.sin(half_yaw)
+    # Hamilton product of yaw quaternion (c, 0, 0, s) with reference
+    res = np.stack([c*w - s*z, c*x - s*y, c*y + s*x, c*z + s*w], axis=1)
+    res /= np.linalg.norm(res, axis=1, keepdims=True)
+    # Keep scalar part positive like quaternion_from_matrix does
+    res[res[:, 0] < 0] *= -1
+
+    return res
+
+
+class PoseChain:
+    """Pick or place poses of a task chain stored as growable arrays, unset poses are marked invalid"""
+
+    def __init__(self, capacity: int = 16) -> None:
+        self.xyz = np.empty((capacity, 3), dtype=np.float64)
+        self.wxyz = np.empty((capacity, 4), dtype=np.float64)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _index(self, index: int) -> int:
+        """Resolve (possibly negative) index like a list does"""
+        if not -self.size <= index < self.size:
+            raise IndexError("pose chain index out of range")
+        return index % self.size
+
+    def __getitem__(self, index: int):
+        """Get (xyz, wxyz) pose at index or None if it is not set"""
+        index = self._index(index)
+        if not self.valid[index]:
+            return None
+        # Same pose format as stored in saved demonstrations
+        return self.xyz[index].tolist(), self.wxyz[index].copy()
+
+    def __setitem__(self, index: int, pose) -> None:
+        """Set (xyz, wxyz) pose at index, None marks it unset"""
+        index = self._index(index)
+        if pose is None:
+            self.valid[index] = False
+        else:
+            self.xyz[index], self.wxyz[index] = pose
+            self.valid[index] = True
+
+    def _maybe_grow(self) -> None:
+        """Double capacity when the buffers are full"""
+        if self.size < len(self.valid):
+            return
+        capacity = 2 * len(self.valid)
+        self.xyz = np.resize(self.xyz, (capacity, 3))
+        self.wxyz = np.resize(self.wxyz, (capacity, 4))
+        self.valid = np.resize(self.valid, capacity)
+
+    def append(self, pose) -> None:
+        self._maybe_grow()
+        self.size += 1
+        self[-1] = pose
+
+    def clear(self) -> None:
+        self.size = 0
+
+    def all_valid(self, stop=None) -> bool:
+        """Check that all poses (up to stop) are set"""
+        return bool(self.valid[:self.size][:stop].all())
+
+    def last_valid(self) -> bool:
+        """Check that the chain is not empty and its last pose is set"""
+        return self.size > 0 and bool(self.valid[self.size - 1])
+
+    def tolist(self) -> List[Any]:
+        return [self[index] for index in range(self.size)]
@@ -0,0 +1,96 @@
+"""Tests for utility functions"""
+import numpy as np
+import pytest
+
+from cliport_label.utils import (
+    MAX_DEPTH,
+    PoseChain,
+    get_avg_3d_centroid,
+    get_pointcloud,
+    get_pose44,
+    get_relative_orientation,
+    get_yaw_orientations,
+)
+
+INTRINSICS = np.array(
+    [[609.9600830078125, 0.0, 336.7248229980469], [0.0, 609.9955444335938, 249.56271362304688], [0.0, 0.0, 1.0]],
+    dtype=np.float32,
+)
+EXTRINSICS = get_pose44([0.5, 0.1, 0.6], [0.05, 0.7, -0.7, 0.1] / np.linalg.norm([0.05, 0.7, -0.7, 0.1]))
+
+
+def make_depth() -> np.ndarray:
+    """Synthetic uint16 depth image in mm with missing and out of range values"""
+    rng = np.random.default_rng(0)
+    depth = rng.integers(300, 900, (480, 640)).astype(np.uint16)
+    depth[rng.random(depth.shape) < 0.2] = 0
+    depth[rng.random(depth.shape) < 0.1] = MAX_DEPTH + rng.integers(0, 100)
+    return depth
+
+
+def test_yaw_orientations_match_relative_orientation() -> None:
+    """Make sure batched yaw orientations match the matrix based single orientation"""
+    rng = np.random.default_rng(0)
+    yaw_rotations = np.arange(36) * 10
+    for _ in range(10):
+        reference = rng.normal(size=4)
+        reference /= np.linalg.norm(reference)
+        orientations = get_yaw_orientations(reference, yaw_rotations)
+        assert orientations.shape == (36, 4)
+        for orientation, yaw_rotation in zip(orientations, yaw_rotations):
+            assert np.allclose(orientation, get_relative_orientation(reference, yaw_rotation))
+
+
+def test_avg_3d_centroid_matches_pointcloud() -> None:
+    """Make sure centroid matches the full pointcloud, median and homogeneous transform computation"""
+    depth = make_depth()
+    bbox = [(200, 150), (330, 260)]
+    xyz = get_pointcloud(depth, INTRINSICS)[150:260, 200:330]
+    valid = (xyz[:, :, 2] > 0) & (xyz[:, :, 2] < MAX_DEPTH)
+    expected_camera = np.median(xyz[valid], axis=0) / 1000
+    expected_world = np.dot(EXTRINSICS, [*expected_camera, 1])[:-1]
+
+    centroid_world, centroid_camera = get_avg_3d_centroid(
+        depth, bbox, np.linalg.inv(INTRINSICS).astype(np.float32), EXTRINSICS
+    )
+    assert centroid_world.shape == centroid_camera.shape == (3,)
+    assert np.allclose(centroid_camera, expected_camera, atol=1e-5)
+    assert np.allclose(centroid_world, expected_world, atol=1e-5)
+
+
+def test_avg_3d_centroid_without_valid_depth() -> None:
+    """Make sure bbox without valid depth values gives NaN centroid"""
+    depth = make_depth()
+    depth[150:260, 200:330] = 0
+    depth[150:200, 200:330] = MAX_DEPTH
+    with pytest.warns(RuntimeWarning):
+        centroid_world, centroid_camera = get_avg_3d_centroid(
+            depth, [(200, 150), (330, 260)], np.linalg.inv(INTRINSICS).astype(np.float32), EXTRINSICS
+        )
+    assert np.isnan(centroid_camera).all()
+    assert np.isnan(centroid_world).all()
+
+
+def test_pose_chain() -> None:
+    """Make sure pose chain grows past capacity, resets poses and lists them in saved demonstration format"""
+    chain = PoseChain(capacity=2)
+    with pytest.raises(IndexError):
+        chain[-1] = None
+    assert not chain.last_valid()
+    for step in range(5):
+        chain.append((np.full(3, step, dtype=np.float32), np.arange(4.0)))
+    assert len(chain) == 5
+    assert chain.all_valid() and chain.last_valid()
+    chain[1] = None
+    chain.append(None)
+    assert not chain.all_valid()
+    assert chain.all_valid(stop=1)
+    assert not chain.last_valid()
+    poses = chain.tolist()
+    assert len(poses) == 6
+    assert poses[1] is None and poses[-1] is None
+    xyz, wxyz = poses[4]
+    assert xyz == [4.0, 4.0, 4.0]
+    assert isinstance(wxyz, np.ndarray) and np.array_equal(wxyz, np.arange(4.0))
+    chain.clear()
+    assert len(chain) == 0 and chain.tolist() == []